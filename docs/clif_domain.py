@@ -12,6 +12,19 @@
 from __future__ import absolute_import
 
 import re
+import weakref
+
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 has intern() as a builtin.
+    pass
+
+try:
+    from types import MappingProxyType
+except ImportError:
+    # Python 2 has no read-only dict view; fall back to a plain dict.
+    MappingProxyType = dict
 
 from docutils import nodes
 from docutils.parsers.rst import directives
@@ -27,6 +40,11 @@ from sphinx.util.nodes import make_refnode
 import sphinx.ext.autodoc
 
 
+# Shared copies of the object type names stored in the domain data, so the
+# thousands of object entries don't each hold their own string.
+_objtypes = dict((t, intern(t)) for t in ('type', 'inst', 'instgroup'))
+
+
 class ClifObject(ObjectDescription):
     """
     Any kind of Cranelift IR object.
@@ -34,11 +52,13 @@ class ClifObject(ObjectDescription):
     This is a shared base class for the different kinds of indexable objects
     in the Cranelift IR reference.
     """
-    option_spec = {
+    # Shared by all the clif directives, and read-only so that nothing can
+    # modify it for one directive and affect the others.
+    option_spec = MappingProxyType({
         'noindex': directives.flag,
         'module': directives.unchanged,
         'annotation': directives.unchanged,
-    }
+    })
 
     def add_target_and_index(self, name, sig, signode):
         """
@@ -48,19 +68,25 @@ class ClifObject(ObjectDescription):
         :param sig: The signature text.
         :param signode: The output node.
         """
-        targetname = self.objtype + '-' + name
-        if targetname not in self.state.document.ids:
+        env = self.env
+        objtype = self.objtype
+        document = self.state.document
+        targetname = '%s-%s' % (objtype, name)
+        if targetname not in document.ids:
             signode['names'].append(targetname)
             signode['ids'].append(targetname)
             signode['first'] = (not self.names)
-            self.state.document.note_explicit_target(signode)
-            inv = self.env.domaindata['clif']['objects']
+            document.note_explicit_target(signode)
+            data = env.domaindata['clif']
+            inv = data['objects']
             if name in inv:
                 self.state_machine.reporter.warning(
-                    'duplicate Cranelift object description of %s, ' % name +
-                    'other instance in ' + self.env.doc2path(inv[name][0]),
+                    'duplicate Cranelift object description of %s, '
+                    'other instance in %s'
+                    % (name, env.doc2path(inv[name][0])),
                     line=self.lineno)
-            inv[name] = (self.env.docname, self.objtype)
+            inv[name] = (env.docname, _objtypes[objtype], targetname)
+            data['by_doc'].setdefault(env.docname, set()).add(name)
 
         indextext = self.get_index_text(name)
         if indextext:
@@ -68,32 +94,59 @@ class ClifObject(ObjectDescription):
                                               targetname, '', None))
 
 
-# Type variables are indicated as %T.
-typevar = re.compile('(\%[A-Z])')
+# Escaped regex fragments of type names, keyed by the unescaped text.
+# functools.lru_cache isn't available on Python 2, and the set of fragments
+# is small, so a plain dict will do.
+_escaped = {}
+
+
+def escape_type_part(part):
+    """Escape a literal fragment of a type name for use in a regex."""
+    # Most fragments are like 'i' or 'x4' and need no escaping at all.
+    if part.isalnum():
+        return part
+    try:
+        return _escaped[part]
+    except KeyError:
+        escaped = _escaped[part] = re.escape(part)
+        return escaped
 
 
 def parse_type(name, signode):
     """
     Parse a type with embedded type vars and append to signode.
 
+    Type variables are indicated as %T.
+
     Return a string that can be compiled into a regular expression matching
     the type.
     """
 
     re_str = ''
 
-    for part in typevar.split(name):
-        if part == '':
-            continue
-        if len(part) == 2 and part[0] == '%':
+    # Type names are short, so a plain scan for '%' beats a regex split.
+    pos = 0
+    idx = name.find('%')
+    while idx >= 0:
+        if idx + 1 < len(name) and 'A' <= name[idx + 1] <= 'Z':
+            if idx > pos:
+                part = name[pos:idx]
+                signode += addnodes.desc_name(part, part)
+                re_str += escape_type_part(part)
             # This is a type parameter. Don't display the %, use emphasis
             # instead.
-            part = part[1]
+            part = name[idx + 1]
             signode += nodes.emphasis(part, part)
             re_str += r'\w+'
+            pos = idx + 2
+            idx = name.find('%', pos)
         else:
-            signode += addnodes.desc_name(part, part)
-            re_str += re.escape(part)
+            # A literal '%' that stays part of the surrounding text.
+            idx = name.find('%', idx + 1)
+    if pos < len(name):
+        part = name[pos:]
+        signode += addnodes.desc_name(part, part)
+        re_str += escape_type_part(part)
     return re_str
 
 
@@ -115,12 +168,9 @@ class ClifType(ClifObject):
         return name + ' (IR type)'
 
 
-sep_equal = re.compile('\s*=\s*')
-sep_comma = re.compile('\s*,\s*')
-
-
 def parse_params(s, signode):
-    for i, p in enumerate(sep_comma.split(s)):
+    for i, p in enumerate(s.split(',')):
+        p = p.strip()
         if i != 0:
             signode += nodes.Text(', ')
         signode += nodes.emphasis(p, p)
@@ -150,14 +200,14 @@ class ClifInst(ClifObject):
         #   v0 = foo
         #   foo op0
 
-        parts = re.split(sep_equal, sig, 1)
-        if len(parts) == 2:
+        lhs, eq, rhs = sig.partition('=')
+        if eq:
             # Outgoing parameters.
-            parse_params(parts[0], signode)
+            parse_params(lhs, signode)
             signode += nodes.Text(' = ')
-            name = parts[1]
+            name = rhs
         else:
-            name = parts[0]
+            name = lhs
 
         # Parse 'name arg, arg'
         parts = name.split(None, 1)
@@ -201,38 +251,50 @@ class CraneliftDomain(Domain):
         'instgroup': XRefRole(),
     }
 
+    # Bump whenever the layout of initial_data changes, so Sphinx discards
+    # pickled environments from older builds.
+    data_version = 2
+
     initial_data = {
-        'objects': {},  # fullname -> docname, objtype
+        'objects': {},  # fullname -> docname, objtype, targetname
+        'by_doc': {},  # docname -> set of fullnames
     }
 
     def clear_doc(self, docname):
-        for fullname, (fn, _l) in list(self.data['objects'].items()):
-            if fn == docname:
-                del self.data['objects'][fullname]
+        objects = self.data['objects']
+        for fullname in self.data['by_doc'].pop(docname, ()):
+            # A later duplicate description may have taken over the name.
+            if objects.get(fullname, (None,))[0] == docname:
+                del objects[fullname]
 
     def merge_domaindata(self, docnames, otherdata):
-        for fullname, (fn, objtype) in otherdata['objects'].items():
+        if not isinstance(docnames, (set, frozenset)):
+            docnames = frozenset(docnames)
+        self.data['objects'].update(
+                (fullname, obj)
+                for fullname, obj in otherdata['objects'].items()
+                if obj[0] in docnames)
+        by_doc = self.data['by_doc']
+        for fn, fullnames in otherdata['by_doc'].items():
             if fn in docnames:
-                self.data['objects'][fullname] = (fn, objtype)
+                by_doc.setdefault(fn, set()).update(fullnames)
 
     def resolve_xref(self, env, fromdocname, builder, typ, target, node,
                      contnode):
-        objects = self.data['objects']
-        if target not in objects:
+        obj = self.data['objects'].get(target)
+        if obj is None:
             return None
-        obj = objects[target]
-        return make_refnode(builder, fromdocname, obj[0],
-                            obj[1] + '-' + target, contnode, target)
+        return make_refnode(builder, fromdocname, obj[0], obj[2],
+                            contnode, target)
 
     def resolve_any_xref(self, env, fromdocname, builder, target,
                          node, contnode):
-        objects = self.data['objects']
-        if target not in objects:
+        obj = self.data['objects'].get(target)
+        if obj is None:
             return []
-        obj = objects[target]
-        return [('clif:' + self.role_for_objtype(obj[1]),
-                 make_refnode(builder, fromdocname, obj[0],
-                              obj[1] + '-' + target, contnode, target))]
+        return [('clif:%s' % self.role_for_objtype(obj[1]),
+                 make_refnode(builder, fromdocname, obj[0], obj[2],
+                              contnode, target))]
 
 
 class TypeDocumenter(sphinx.ext.autodoc.Documenter):
@@ -247,7 +309,7 @@ class TypeDocumenter(sphinx.ext.autodoc.Documenter):
         return False
 
     def resolve_name(self, modname, parents, path, base):
-        return 'base.types', [base]
+        return 'base.types', (base,)
 
     def add_content(self, more_content, no_docstring=False):
         super(TypeDocumenter, self).add_content(more_content, no_docstring)
@@ -272,79 +334,86 @@ class InstDocumenter(sphinx.ext.autodoc.Documenter):
 
     def resolve_name(self, modname, parents, path, base):
         if path:
-            return path.rstrip('.'), [base]
+            return path.rstrip('.'), (base,)
         else:
-            return 'base.instructions', [base]
+            return 'base.instructions', (base,)
 
     def format_signature(self):
         inst = self.object
-        sig = inst.name
+        parts = []
         if len(inst.outs) > 0:
-            sig = ', '.join([op.name for op in inst.outs]) + ' = ' + sig
+            parts.append(', '.join([op.name for op in inst.outs]))
+            parts.append(' = ')
+        parts.append(inst.name)
         if len(inst.ins) > 0:
             op = inst.ins[0]
-            sig += ' ' + op.name
+            parts.append(' ')
+            parts.append(op.name)
             # If the first input is variable-args, this is 'return'. No parens.
             if op.kind.name == 'variable_args':
-                sig += '...'.format(op.name)
+                parts.append('...')
             for op in inst.ins[1:]:
                 # This is a call or branch with args in (...).
                 if op.kind.name == 'variable_args':
-                    sig += '({}...)'.format(op.name)
+                    parts.append('(%s...)' % op.name)
                 else:
-                    sig += ', ' + op.name
-        return sig
+                    parts.append(', ')
+                    parts.append(op.name)
+        return ''.join(parts)
 
     def add_directive_header(self, sig):
         """Add the directive header and options to the generated content."""
-        domain = getattr(self, 'domain', 'clif')
-        directive = getattr(self, 'directivetype', self.objtype)
         sourcename = self.get_sourcename()
-        self.add_line(u'.. %s:%s:: %s' % (domain, directive, sig), sourcename)
+        self.add_line(
+                u'.. %s:%s:: %s' % (self.domain, self.directivetype, sig),
+                sourcename)
         if self.options.noindex:
             self.add_line(u'   :noindex:', sourcename)
 
+    def add_lines(self, lines, source):
+        """
+        Append each of ``lines`` to the generated content as one entry.
+
+        This is what calling ``add_line()`` on every line does, without the
+        per-line method call.
+        """
+        indent = self.indent
+        append = self.directive.result.append
+        for line in lines:
+            append(indent + line, source)
+
     def add_content(self, more_content, no_docstring=False):
         super(InstDocumenter, self).add_content(more_content, no_docstring)
         sourcename = self.get_sourcename()
         inst = self.object
+        lines = []
+        emit = lines.append
 
         # Add inputs and outputs.
-        for op in inst.ins:
-            if op.is_value():
-                typ = op.typevar
-            else:
-                typ = op.kind
-            self.add_line(u':in {} {}: {}'.format(
-                typ, op.name, op.get_doc()), sourcename)
-        for op in inst.outs:
-            if op.is_value():
-                typ = op.typevar
-            else:
-                typ = op.kind
-            self.add_line(u':out {} {}: {}'.format(
-                typ, op.name, op.get_doc()), sourcename)
+        for field, operands in ((u'in', inst.ins), (u'out', inst.outs)):
+            for op in operands:
+                typ = op.typevar if op.is_value() else op.kind
+                emit(u':%s %s %s: %s' % (field, typ, op.name, op.get_doc()))
 
         # Document type inference for polymorphic instructions.
         if inst.is_polymorphic:
             if inst.ctrl_typevar is not None:
                 if inst.use_typevar_operand:
                     tvopnum = inst.value_opnums[inst.format.typevar_operand]
-                    self.add_line(
-                            u':typevar {}: inferred from {}'
-                            .format(
-                                inst.ctrl_typevar.name,
-                                inst.ins[tvopnum]),
-                            sourcename)
+                    emit(u':typevar %s: inferred from %s'
+                         % (inst.ctrl_typevar.name, inst.ins[tvopnum]))
                 else:
-                    self.add_line(
-                            u':typevar {}: explicitly provided'
-                            .format(inst.ctrl_typevar.name),
-                            sourcename)
+                    emit(u':typevar %s: explicitly provided'
+                         % inst.ctrl_typevar.name)
             for tv in inst.other_typevars:
-                self.add_line(
-                        u':typevar {}: from input operand'.format(tv.name),
-                        sourcename)
+                emit(u':typevar %s: from input operand' % tv.name)
+
+        self.add_lines(lines, sourcename)
+
+
+# Sorted instruction names per instruction group. The groups are complete by
+# the time they are documented, so the names only need sorting once.
+_sorted_names_cache = weakref.WeakKeyDictionary()
 
 
 class InstGroupDocumenter(sphinx.ext.autodoc.ModuleLevelDocumenter):
@@ -366,14 +435,23 @@ class InstGroupDocumenter(sphinx.ext.autodoc.ModuleLevelDocumenter):
                 more_content, no_docstring)
         sourcename = self.get_sourcename()
         indexed = self.env.domaindata['clif']['objects']
-
-        names = [inst.name for inst in self.object.instructions]
-        names.sort()
+        add_line = self.add_line
+
+        names = _sorted_names_cache.get(self.object)
+        if names is None:
+            names = tuple(sorted(inst.name
+                                 for inst in self.object.instructions))
+            _sorted_names_cache[self.object] = names
+        if not indexed:
+            # No instructions are indexed yet, so there is nothing to link to.
+            for name in names:
+                add_line(u'``%s``' % name, sourcename)
+            return
         for name in names:
             if name in indexed:
-                self.add_line(u':clif:inst:`{}`'.format(name), sourcename)
+                add_line(u':clif:inst:`%s`' % name, sourcename)
             else:
-                self.add_line(u'``{}``'.format(name), sourcename)
+                add_line(u'``%s``' % name, sourcename)
 
 
 def setup(app):